@@ -17,16 +17,22 @@
 # limitations under the License.
 
 
-import dataclasses
-import json
+import asyncio
+import collections
+import concurrent.futures
+import errno
+import io
 import logging
 import os
 import subprocess
 import tarfile
 import tempfile
+import threading
+import typing
 
 import dacite
 import falcon.asgi
+import orjson
 from whitesource_common import protocol
 
 import model
@@ -36,6 +42,16 @@ import util
 
 logger = logging.getLogger(__name__)
 
+# websocket close code for unexpected server side conditions (RFC 6455)
+_CLOSE_CODE_INTERNAL_ERROR = 1011
+_GENERATED_CONFIG_NAME = 'wss-generated-file.config'
+# lines of agent output kept for the scan result, per stream
+_AGENT_LOG_MAX_LINES = 10000
+# multiple of the 512 byte tar record size, avoids a read per record when streaming the upload
+_TAR_BUFSIZE = 2 * 1024 * 1024
+# smaller files are not worth the extra syscall for preallocation
+_PREALLOCATE_MIN_SIZE = 1024 * 1024
+
 
 class Component:
 
@@ -46,18 +62,18 @@ class Component:
 
             logger.info('receiving metadata...')
             try:
-                metadata = dacite.from_dict(
+                metadata = _from_json(
                     data_class=protocol.WhiteSourceApiExtensionWebsocketMetadata,
-                    data=json.loads(await ws.receive_text()),
+                    text=await ws.receive_text(),
                 )
 
                 logger.info('receiving whitesource config...')
-                ws_config = dacite.from_dict(
+                ws_config = _from_json(
                     data_class=protocol.WhiteSourceApiExtensionWebsocketWSConfig,
-                    data=json.loads(await ws.receive_text()),
+                    text=await ws.receive_text(),
                 )
 
-            except (json.decoder.JSONDecodeError, dacite.exceptions.MissingValueError):
+            except (orjson.JSONDecodeError, TypeError):
                 await ws.close(
                     code=protocol.WhiteSourceApiExtensionStatusCodeReasons.CONTRACT_VIOLATION.value
                 )
@@ -71,65 +87,44 @@ class Component:
                 )
                 return
 
-            with tempfile.TemporaryDirectory() as tmp_dir:
+            with tempfile.TemporaryDirectory(dir=paths.tmp_dir) as tmp_dir:
                 plogger.info('transfer start')
-                with tempfile.NamedTemporaryFile() as tar_file:
-                    received = 0
-                    while received < metadata.length:
-                        chunk = await ws.receive_data()
-                        tar_file.write(chunk)
-                        plogger.info(
-                            f'{util.sizeof_fmt(received)}/{util.sizeof_fmt(metadata.length)} '
-                            f'({received}/{metadata.length})'
-                        )
-                        received += len(chunk)
-                    tar_file.seek(0)
-                    plogger.info(
-                        f'{util.sizeof_fmt(received)}/{util.sizeof_fmt(metadata.length)} '
-                        f'({received}/{metadata.length})'
+                loop = asyncio.get_running_loop()
+                component_stream = _WebSocketReader(
+                    ws=ws,
+                    loop=loop,
+                    length=metadata.length,
+                    plogger=plogger,
+                )
+                try:
+                    # extraction runs in a thread, pulling frames from the websocket on demand
+                    await loop.run_in_executor(
+                        None,
+                        _extract_component,
+                        io.BufferedReader(component_stream, buffer_size=_TAR_BUFSIZE),
+                        tmp_dir,
+                        plogger,
+                    )
+                except (
+                        tarfile.ReadError,
+                        UnicodeDecodeError,
+                        tarfile.InvalidHeaderError,
+                ):
+                    await ws.close(
+                        code=protocol.WhiteSourceApiExtensionStatusCodeReasons
+                            .BINARY_CORRUPTED.value
                     )
-                    plogger.info('transfer done')
-                    try:
-
-                        # extract top tar
-                        with tarfile.open(fileobj=tar_file, mode='r|*', bufsize=1024) as f:
-                            while tar_info := f.next():
-                                f.extract(tar_info, path=tmp_dir, set_attrs=False)
-
-                        # extract each oci layer in seperate tar, rm .tar afterwards
-                        for file in os.listdir(tmp_dir):
-                            if file.endswith('.tar'):
-                                with tarfile.open(
-                                        os.path.join(tmp_dir, file),
-                                        mode='r|*', bufsize=1024,
-                                ) as f:
-                                    try:
-                                        while tar_info := f.next():
-                                            f.extract(
-                                                tar_info,
-                                                path=os.path.join(tmp_dir, file.replace('.tar', '')),
-                                                set_attrs=False,
-                                            )
-                                    except (tarfile.StreamError, KeyError) as e:
-                                        if isinstance(e, tarfile.StreamError):
-                                            # https://bugs.python.org/issue12800
-                                            plogger.warn('skipping duplicate (probably symlink)')
-                                        elif isinstance(e, KeyError):
-                                            plogger.warn('linkname not found, skipping')
-                                        else:
-                                            raise e
-                                os.remove(os.path.join(tmp_dir, file))
-
-                    except (
-                            tarfile.ReadError,
-                            UnicodeDecodeError,
-                            tarfile.InvalidHeaderError,
-                    ):
-                        await ws.close(
-                            code=protocol.WhiteSourceApiExtensionStatusCodeReasons
-                                .BINARY_CORRUPTED.value
-                        )
-                        return
+                    return
+                except OSError as e:
+                    if e.errno != errno.ENOSPC:
+                        raise
+                    plogger.error(f'no space left on device for extraction in {tmp_dir=}')
+                    await ws.close(code=_CLOSE_CODE_INTERNAL_ERROR)
+                    return
+
+                # the tar end-of-archive marker may precede the end of the upload
+                await component_stream.drain()
+                plogger.info('transfer done')
 
                 plogger.info('scan start')
                 wss_agent_hardlink_path = util.get_wss_agent_hardlink(tmp_dir=tmp_dir)
@@ -143,10 +138,10 @@ class Component:
                 os.unlink(wss_agent_hardlink_path)
 
                 if result.returncode == 0:
-                    agent_log_str = (result.stdout.decode('utf-8') or '')
+                    agent_log = result.stdout
                 else:
-                    agent_log_str = (result.stderr.decode('utf-8') or '') + \
-                    (result.stdout.decode('utf-8') or '')
+                    agent_log = result.stderr + result.stdout
+                agent_log_str = agent_log.decode('utf-8', errors='replace')
 
                 res = _build_scan_result_response(
                     successful=True if result.returncode == 0 else False,
@@ -154,12 +149,215 @@ class Component:
                 )
 
                 await ws.send_text(str(result.returncode))
-                await ws.send_text(json.dumps(dataclasses.asdict(res)))
+                await ws.send_text(orjson.dumps(res).decode('utf-8'))
 
         except falcon.WebSocketDisconnected:
             return
 
 
+def _from_json(
+    data_class: type,
+    text: str,
+):
+    # protocol dataclasses have no nested types, so dacite's type coercion is not needed
+    # unknown keys are ignored like dacite does, wrong value types raise TypeError
+    data = orjson.loads(text)
+    if not isinstance(data, dict):
+        raise TypeError(f'expected a json object for {data_class.__name__}')
+    field_types = typing.get_type_hints(data_class)
+    values = {key: value for key, value in data.items() if key in field_types}
+    for key, value in values.items():
+        if not _is_instance(value, field_types[key]):
+            raise TypeError(f'{key} of {data_class.__name__} has wrong type {type(value)}')
+    return data_class(**values)
+
+
+def _is_instance(value, type_hint) -> bool:
+    if type_hint is typing.Any:
+        return True
+    if typing.get_origin(type_hint) is typing.Union:
+        return any(_is_instance(value, arg) for arg in typing.get_args(type_hint))
+    # generics like typing.Dict[str, str] are checked by their origin only
+    return isinstance(value, typing.get_origin(type_hint) or type_hint)
+
+
+class _WebSocketReader(io.RawIOBase):
+    '''
+    blocking file-like view on the archive sent over the websocket. Meant to be read from an
+    executor thread, every read is dispatched as one batch of receives to the event loop.
+    '''
+
+    def __init__(
+        self,
+        ws: falcon.asgi.WebSocket,
+        loop: asyncio.AbstractEventLoop,
+        length: int,
+        plogger: logging.Logger,
+    ):
+        self._ws = ws
+        self._loop = loop
+        self._length = length
+        self._plogger = plogger
+        self._pending = memoryview(b'')
+        self.received = 0
+
+        # log progress in steps of one percent only
+        self._log_step = max(length // 100, 1)
+        self._next_log = self._log_step
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer) -> int:
+        if not self._pending:
+            if self.received >= self._length:
+                return 0
+            return asyncio.run_coroutine_threadsafe(
+                self._receive_into(buffer),
+                self._loop,
+            ).result()
+
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+    async def _receive_into(self, buffer) -> int:
+        # fill the whole buffer from consecutive frames, instead of a loop round trip per frame
+        view = memoryview(buffer).cast('B')
+        size = 0
+        while size < len(view) and self.received < self._length:
+            chunk = memoryview(await self._receive())
+            taken = min(len(chunk), len(view) - size)
+            view[size:size + taken] = chunk[:taken]
+            size += taken
+            self._pending = chunk[taken:]
+        return size
+
+    async def drain(self):
+        while self.received < self._length:
+            await self._receive()
+
+    async def _receive(self) -> bytes:
+        chunk = await self._ws.receive_data()
+        self.received += len(chunk)
+        if self.received >= self._next_log or self.received >= self._length:
+            self._next_log = (self.received // self._log_step + 1) * self._log_step
+            self._plogger.info(
+                f'{util.sizeof_fmt(self.received)}/{util.sizeof_fmt(self._length)} '
+                f'({self.received}/{self._length})'
+            )
+        return chunk
+
+
+def _extract_component(
+    fileobj,
+    tmp_dir: str,
+    plogger: logging.Logger,
+):
+    # extract top tar
+    with _PreallocatingTarFile.open(fileobj=fileobj, mode='r|*', bufsize=_TAR_BUFSIZE) as f:
+        _extractall(tar=f, path=tmp_dir)
+
+    with os.scandir(tmp_dir) as entries:
+        layer_paths = [
+            entry.path
+            for entry in entries
+            if entry.is_file() and entry.name.endswith('.tar')
+        ]
+    if not layer_paths:
+        return
+
+    # extract each oci layer in seperate tar, layers are independent of each other
+    # threads suffice, zlib releases the GIL while decompressing
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(len(layer_paths), os.cpu_count() or 1, 8),
+    ) as executor:
+        futures = [
+            executor.submit(
+                _extract_layer,
+                layer_path,
+                layer_path[:-len('.tar')],
+                plogger,
+            )
+            for layer_path in layer_paths
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+
+
+def _extract_layer(
+    layer_path: str,
+    dest: str,
+    plogger: logging.Logger,
+):
+    # layers are on local disk, seekable mode avoids the buffering of the stream mode
+    with _PreallocatingTarFile.open(layer_path, mode='r:*') as f:
+        try:
+            _extractall(tar=f, path=dest)
+        except KeyError:
+            plogger.warn('linkname not found, skipping')
+    os.remove(layer_path)
+
+
+class _PreallocatingTarFile(tarfile.TarFile):
+    '''
+    allocates the blocks of larger extracted files in one call, their size is known upfront.
+    '''
+
+    def makefile(self, tarinfo, targetpath):
+        if tarinfo.sparse is not None or tarinfo.size < _PREALLOCATE_MIN_SIZE:
+            return super().makefile(tarinfo, targetpath)
+
+        source = self.fileobj
+        source.seek(tarinfo.offset_data)
+        with open(targetpath, 'wb') as target:
+            try:
+                os.posix_fallocate(target.fileno(), 0, tarinfo.size)
+            except (AttributeError, OSError):
+                # not available on this platform or file system
+                pass
+            tarfile.copyfileobj(
+                source,
+                target,
+                tarinfo.size,
+                tarfile.ReadError,
+                self.copybufsize,
+            )
+
+
+def _extraction_filter(member: tarfile.TarInfo, path: str):
+    try:
+        member = tarfile.tar_filter(member, path)
+    except tarfile.FilterError as e:
+        logger.warning(f'skipping {member.name}: {e}')
+        return None
+
+    # attributes are irrelevant for the scan, skip restoring them
+    return member.replace(
+        mode=None,
+        uid=None,
+        gid=None,
+        uname=None,
+        gname=None,
+        mtime=None,
+        deep=False,
+    )
+
+
+def _extractall(
+    tar: tarfile.TarFile,
+    path: str,
+):
+    # extraction filters are available since python 3.12 and as security backport
+    if hasattr(tarfile, 'tar_filter'):
+        tar.extractall(path=path, filter=_extraction_filter)
+    else:
+        # without filters extractall would restore attributes, extract member-wise instead
+        for tar_info in tar:
+            tar.extract(tar_info, path=path, set_attrs=False)
+
+
 def _build_scan_result_response(
     successful: bool,
     message: str,
@@ -216,12 +414,14 @@ def _scan_component(
     plogger: logging.Logger,
 ) -> subprocess.CompletedProcess:
 
+    # detection depends on the package managers found in the component, not cacheable
     generate_config(
         wss_agent_dir=wss_agent_dir,
         java_path=paths.java_path,
     )
 
-    with open(os.path.join(wss_agent_dir, 'wss-generated-file.config'), 'a') as config_file:
+    config_path = os.path.join(wss_agent_dir, _GENERATED_CONFIG_NAME)
+    with open(config_path, 'a') as config_file:
         _add_configuration(
             file=config_file,
             ws_config=ws_config,
@@ -236,9 +436,10 @@ def _scan_component(
     result = run_whitesource_scan(
         wss_agent_dir=wss_agent_dir,
         component_path=component_path,
-        config_path=os.path.join(wss_agent_dir, 'wss-generated-file.config'),
+        config_path=config_path,
         java_path=paths.java_path,
         ws_config=ws_config,
+        plogger=plogger,
     )
     return result
 
@@ -249,6 +450,7 @@ def run_whitesource_scan(
     java_path: str,
     ws_config: protocol.WhiteSourceApiExtensionWebsocketWSConfig,
     config_path: str,
+    plogger: logging.Logger,
 ) -> subprocess.CompletedProcess:
     wss_agent_path = os.path.join(wss_agent_dir, paths.wss_agent_name)
     args = [
@@ -268,8 +470,47 @@ def run_whitesource_scan(
         # '-projectVersion', ws_config.projectVersion,
     ]
 
-    return subprocess.run(
+    # stream agent output to the log while it runs, keep only the tail for the scan result
+    stdout = collections.deque(maxlen=_AGENT_LOG_MAX_LINES)
+    stderr = collections.deque(maxlen=_AGENT_LOG_MAX_LINES)
+    with subprocess.Popen(
         args,
         cwd=wss_agent_dir,
-        capture_output=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    ) as proc:
+        forwarders = [
+            threading.Thread(
+                target=_forward_agent_output,
+                args=(proc.stdout, stdout, plogger.info),
+                daemon=True,
+            ),
+            threading.Thread(
+                target=_forward_agent_output,
+                args=(proc.stderr, stderr, plogger.warning),
+                daemon=True,
+            ),
+        ]
+        for forwarder in forwarders:
+            forwarder.start()
+        for forwarder in forwarders:
+            forwarder.join()
+        returncode = proc.wait()
+
+    return subprocess.CompletedProcess(
+        args=args,
+        returncode=returncode,
+        stdout=b''.join(stdout),
+        stderr=b''.join(stderr),
     )
+
+
+def _forward_agent_output(
+    pipe,
+    lines: collections.deque,
+    log: typing.Callable[[str], None],
+):
+    with pipe:
+        for line in iter(pipe.readline, b''):
+            lines.append(line)
+            log(line.decode('utf-8', errors='replace').rstrip())
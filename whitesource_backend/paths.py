@@ -24,4 +24,6 @@ wss_agent_dir = '/tmp'
 wss_agent_name = 'wss_unified_agent.jar'
 wss_agent_path = os.path.join(wss_agent_dir, wss_agent_name)
 java_path = shutil.which(cmd='java')
+# per request scratch space (e.g. a tmpfs mount), defaults to the system tmp dir
+tmp_dir = os.environ.get('WS_TMP_DIR')
 static_config_path = '../whitesource-fs-agent.config' # noqa E501
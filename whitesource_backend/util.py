@@ -18,13 +18,19 @@
 
 
 from copy import copy
+import atexit
 import datetime
+import errno
 import logging
+import logging.handlers
+import math
 import os
+import queue
 import shutil
 import sys
 import tempfile
 import threading
+import time
 
 import requests
 
@@ -34,9 +40,32 @@ import paths
 logger = logging.getLogger(__name__)
 # noqa disables flake8 linting for error E501 = line too long
 ws_agent_url = 'https://github.com/whitesource/unified-agent-distribution/releases/latest/download/wss-unified-agent.jar'  # noqa: E501
+# agent staleness is checked at most once per interval (seconds)
+_agent_check_interval = 3600
+_agent_check_lock = threading.Lock()
+_last_agent_check = None
+_queue_listener = None
+# reused for agent updates, keeps connections to github alive
+_session = requests.Session()
 
 
 def update_or_download_agent():
+    global _last_agent_check
+
+    with _agent_check_lock:
+        if (
+            _last_agent_check is not None
+            and time.monotonic() - _last_agent_check < _agent_check_interval
+        ):
+            return
+
+        _update_or_download_agent()
+        # retry on next call if there is still no agent
+        if os.path.isfile(path=paths.wss_agent_path):
+            _last_agent_check = time.monotonic()
+
+
+def _update_or_download_agent():
     if os.path.isfile(path=paths.wss_agent_path):
         modification_date = datetime.datetime.fromtimestamp(os.stat(paths.wss_agent_path).st_mtime)
         if modification_date < datetime.datetime.now() - datetime.timedelta(hours=24):
@@ -68,42 +97,75 @@ def get_wss_agent_hardlink(tmp_dir: str) -> str:
     # at this point the wss_agent is present on the machine
     # creating a hard link so the current agent will not be garbage collected
     wss_agent_hardlink_path = os.path.join(tmp_dir, paths.wss_agent_name)
-    os.link(src=paths.wss_agent_path, dst=wss_agent_hardlink_path)
+    try:
+        os.link(src=paths.wss_agent_path, dst=wss_agent_hardlink_path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # tmp dir is on another file system than the agent (e.g. tmpfs)
+        _copy_file(src=paths.wss_agent_path, dst=wss_agent_hardlink_path)
 
     return wss_agent_hardlink_path
 
 
+def _copy_file(src: str, dst: str):
+    # copy_file_range copies in kernel (reflink on CoW file systems), available since python 3.8
+    if hasattr(os, 'copy_file_range'):
+        try:
+            with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+                remaining = os.fstat(src_file.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(src_file.fileno(), dst_file.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            if remaining == 0:
+                return
+        except OSError as e:
+            # not supported by kernel or file system
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+
+    shutil.copyfile(src=src, dst=dst)
+
+
 def pull_latest_wss_agent(wss_agent_path: str):
     # write res stream in tmp file because of multi threading
-    tmp_file = None
+    # placed next to the agent, so the final move is an atomic rename on the same file system
+    tmp_fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(wss_agent_path),
+        prefix=f'{os.path.basename(wss_agent_path)}.',
+        suffix='.part',
+    )
     try:
-        tmp_file = tempfile.NamedTemporaryFile(delete=False)
-        with requests.get(url=ws_agent_url, stream=True) as res:
+        with open(tmp_fd, 'wb', buffering=1024 * 1024) as tmp_file:
+            with _session.get(url=ws_agent_url, stream=True) as res:
 
-            res.raise_for_status()
+                res.raise_for_status()
 
-            for chunk in res.iter_content(chunk_size=8192):
-                tmp_file.write(chunk)
+                res.raw.decode_content = True
+                shutil.copyfileobj(res.raw, tmp_file, length=1024 * 1024)
 
-            logger.info('agent downloaded. Moving it to tmp dir...')
+        logger.info('agent downloaded. Moving it to tmp dir...')
 
-            shutil.move(src=tmp_file.name, dst=wss_agent_path)
-        tmp_file.close()
+        os.replace(src=tmp_path, dst=wss_agent_path)
 
         logger.info('ws agent pulled successfully.')
 
     except Exception:
         logger.error('an error occured while pulling ws agent')
-        os.unlink(tmp_file.name)
+        os.unlink(tmp_path)
         raise RuntimeError('error pulling wss agent')
 
 
+_size_units = ('', 'Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi', 'Yi')
+
+
 def sizeof_fmt(num, suffix='B'):
-    for unit in ['','Ki','Mi','Gi','Ti','Pi','Ei','Zi']:
-        if abs(num) < 1024.0:
-            return "%3.1f%s%s" % (num, unit, suffix)
-        num /= 1024.0
-    return "%.1f%s%s" % (num, 'Yi', suffix)
+    if num == 0:
+        return f'0.0{suffix}'
+    exp = min(max(int(math.log2(abs(num))) // 10, 0), len(_size_units) - 1)
+    return f'{num / (1 << (exp * 10)):3.1f}{_size_units[exp]}{suffix}'
 
 
 class CCFormatter(logging.Formatter):
@@ -118,6 +180,10 @@ class CCFormatter(logging.Formatter):
         f'{Bcolors.BOLD}{Bcolors.RED}{level_name}{Bcolors.RESET_ALL}',
     }
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._isatty = sys.stdout.isatty()
+
     def color_level_name(self, level_name, level_number):
         def default(level_name):
             return str(level_name)
@@ -126,13 +192,16 @@ class CCFormatter(logging.Formatter):
         return func(level_name)
 
     def formatMessage(self, record):
+        if not self._isatty:
+            # nothing to alter, no need to copy the record
+            record.__dict__["levelprefix"] = record.levelname
+            return super().formatMessage(record)
+
         record_copy = copy(record)
-        levelname = record_copy.levelname
-        if sys.stdout.isatty():
-            levelname = self.color_level_name(levelname, record_copy.levelno)
-            if "color_message" in record_copy.__dict__:
-                record_copy.msg = record_copy.__dict__["color_message"]
-                record_copy.__dict__["message"] = record_copy.getMessage()
+        levelname = self.color_level_name(record_copy.levelname, record_copy.levelno)
+        if "color_message" in record_copy.__dict__:
+            record_copy.msg = record_copy.__dict__["color_message"]
+            record_copy.__dict__["message"] = record_copy.getMessage()
         record_copy.__dict__["levelprefix"] = levelname
         return super().formatMessage(record_copy)
 
@@ -154,18 +223,46 @@ def configure_default_logging(
     if not stdout_level:
         stdout_level = logging.INFO
 
+    global _queue_listener
+
     # make sure to have a clean root logger (in case setup is called multiple times)
     if force:
         for h in logging.root.handlers:
             logging.root.removeHandler(h)
             h.close()
+        _stop_queue_listener()
 
     sh = logging.StreamHandler(stream=sys.stdout)
     sh.setLevel(stdout_level)
     sh.setFormatter(CCFormatter(fmt=get_default_fmt_string(tid=tid)))
-    logging.root.addHandler(hdlr=sh)
+
+    # records are written to stdout by a separate thread, so logging never blocks the event loop
+    log_queue = queue.SimpleQueue()
+    _queue_listener = logging.handlers.QueueListener(log_queue, sh, respect_handler_level=True)
+    _queue_listener.start()
+
+    logging.root.addHandler(hdlr=_InProcessQueueHandler(log_queue))
     logging.root.setLevel(level=stdout_level)
 
 
+class _InProcessQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # the queue never leaves the process, so the record needs no pickling preparation.
+        # Merging args into msg would break CCFormatter using the color_message with the args
+        return record
+
+
+def _stop_queue_listener():
+    global _queue_listener
+
+    # flushes pending records
+    if _queue_listener:
+        _queue_listener.stop()
+        _queue_listener = None
+
+
+atexit.register(_stop_queue_listener)
+
+
 def get_default_fmt_string(tid: bool):
     return f'%(asctime)s [%(levelprefix)s] {"TID:%(thread)d " if tid else ""}%(name)s: %(message)s'